@@ -0,0 +1,51 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+''' Compiled kernel for weighted_nanmean.py
+
+Build it next to weighted_nanmean.py with:
+    CFLAGS="-O3 -march=native" cythonize -i _wnm.pyx
+Do not add -ffast-math: it allows the compiler to drop both the isnan check
+and the compensation terms of the summation.
+
+The kernel reads C-contiguous float32 or float64 x without copying it (the
+sums are always accumulated in double); x of any other dtype, layout or byte
+order is copied to float64 first. The weights are passed without broadcasting
+them to the shape of x. '''
+
+from cython cimport floating
+from libc.math cimport isnan, fabs
+
+def wnm(const floating[:, ::1] x_rows, const double[::1] w):
+    ''' Given x as 2d rows and weights w, where all of row r gets weight w[r%len(w)],
+        return the weighted mean of the not-nan elements of x in a single pass.
+        Both sums use Neumaier compensated summation; returns nan if the
+        valid weights sum to 0 (cdivision gives IEEE 0/0). '''
+    cdef Py_ssize_t r, i, k = w.shape[0]
+    cdef Py_ssize_t nrows = x_rows.shape[0], ncols = x_rows.shape[1]
+    cdef double num = 0.0, num_c = 0.0, den = 0.0, den_c = 0.0, w_r, v, t
+
+    if k == 0 and nrows != 0 or k != 0 and nrows % k != 0:
+        raise ValueError("the number of rows should be a multiple of len(w)")
+
+    with nogil:
+        for r in range(nrows):
+            w_r = w[r % k]
+            for i in range(ncols):
+                if isnan(x_rows[r, i]):
+                    continue
+
+                v = w_r*x_rows[r, i]
+                t = num + v
+                if fabs(num) >= fabs(v):
+                    num_c += (num - t) + v
+                else:
+                    num_c += (v - t) + num
+                num = t
+
+                t = den + w_r
+                if fabs(den) >= fabs(w_r):
+                    den_c += (den - t) + w_r
+                else:
+                    den_c += (w_r - t) + den
+                den = t
+
+    return (num + num_c)/(den + den_c)
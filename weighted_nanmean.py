@@ -1,20 +1,64 @@
-def weighted_mean(x,weights=None):
-    if weights is None:
-        weights = np.ones(x.shape)
-    return np.sum(weights*x)/np.sum(weights)
+import numpy as np
 
-def nanmean(x):
-    x = x[~np.isnan(x)] # this flattens the array
-    return np.sum(x)/float(len(x))
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = None
 
-def weighted_nanmean(x,weights=None):
-    if weights is None:
-        weights = np.ones(x.shape)
+# bottleneck accumulates in the dtype of its input, which loses far too much
+# precision for large float32 fields, so it is only used for float64
+def _nansum(a):
+    if bn is not None and a.dtype==np.float64:
+        return bn.nansum(a)
+    return np.nansum(a,dtype=np.float64)
+
+def _nanmean(a):
+    if bn is not None and a.dtype==np.float64:
+        return bn.nanmean(a)
+    return np.nanmean(a,dtype=np.float64)
+
+try:
+    # Compiled with cython from _wnm.pyx, see the build notes in that file
+    from _wnm import wnm as _wnm_cython
+except ImportError:
+    _wnm_cython = None
 
-    weights = weights[~np.isnan(x)]
-    x = x[~np.isnan(x)] # x and weights still correspond
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
-    return np.sum(weights*x)/np.sum(weights)
+if njit is not None:
+    # fastmath without 'nnan', which would allow numba to drop the isnan check;
+    # the numpy error model returns nan instead of raising when den is 0
+    @njit(parallel=True,fastmath={'nsz','arcp','contract','afn','reassoc'},
+          error_model='numpy')
+    def _wnm_kernel(x_rows,w):
+        ''' Weighted mean of the not-nan elements of x_rows in a single pass,
+            where row r of x_rows has weight w[r%len(w)] (see `_as_rows`) '''
+        k = w.size
+        num = 0.0
+        den = 0.0
+        for r in prange(x_rows.shape[0]):
+            w_r = np.float64(w[r%k])
+            for i in range(x_rows.shape[1]):
+                v = x_rows[r,i]
+                if not np.isnan(v):
+                    num += w_r*v
+                    den += w_r
+        return num/den
+else:
+    _wnm_kernel = None
+
+def weighted_mean(x,weights=None):
+    if weights is None:
+        return x.mean()
+    return np.einsum('...,...->',weights,x,optimize=True)/np.sum(weights)
+
+def nanmean(x):
+    valid = ~np.isnan(x)
+    x = np.where(valid,x,0.0) # nans are zeroed out instead of removed
+    return np.sum(x)/float(valid.sum())
 
 def weighted_nanmean(x,weights=None,axis=None):
     """ Apply weights along a specified axis before calculating the overall mean, while ignoring nans.
@@ -22,11 +66,16 @@ def weighted_nanmean(x,weights=None,axis=None):
     Numpy's `nanmean` cannot deal with weights and numpy's `ma.average` can only calculate the weighted mean along a given axis.
     Note that `np.mean(np.nanmean(x,axis=0)) != np.mean(np.nanmean(x,axis=1))` for data with nans, because the not-nan elements in the corresponding rows/columns get relatively more weight.
 
-    This function asserts that weights assumes the same shape as x before removing the nans and flattening the arrays in the process.
+    This function asserts that weights broadcasts to the shape of x before masking out the nans.
     """
     if weights is None:
-        weights = np.ones(x.shape)
-    weights = np.asarray(weights,dtype=float)
+        # Without weights the axis makes no difference to the overall mean
+        return _nanmean(x)
+    # Only float32 and float64 weights are used without a copy; the sums
+    # below always accumulate in float64
+    weights = np.asarray(weights)
+    if weights.dtype not in (np.float32,np.float64):
+        weights = weights.astype(np.float64)
 
     if axis is None:
         assert weights.shape==x.shape, (
@@ -35,23 +84,79 @@ def weighted_nanmean(x,weights=None,axis=None):
         assert len(weights.shape)==1 and len(weights)==x.shape[axis], (
             "weights should be 1d with same length as specified axis")
 
-    if axis and len(x.shape)!=1:
+    if axis is not None and len(x.shape)!=1:
         # e.g. if x.shape = (a,b,c,d) and axis = 2 weights is
-        # reshaped to (1,1,c,1) and tiled along the other dims (a,b,1,d)
+        # reshaped to (1,1,c,1) and broadcast along the other dims (a,b,1,d)
         weights_shape = np.ones(len(x.shape),dtype=int)
         weights_shape[axis] = x.shape[axis]
-        tile_shape = list(x.shape)
-        tile_shape[axis]=1
         weights = weights.reshape(weights_shape)
-        weights = np.tile(weights,tile_shape)
 
-    assert weights.shape==x.shape, "I messed up"
+    assert np.broadcast_shapes(weights.shape,x.shape)==x.shape, "I messed up"
+
+    return _weighted_nanmean_prebroadcast(x,weights)
+
+def _as_rows(x,weights):
+    ''' Given x and weights with the same number of dims that broadcast to x,
+        return x as 2d rows and the weights as a 1d array w, such that all of
+        row r gets weight w[r%len(w)], without broadcasting the weights '''
+    nonunit = [d for d,n in enumerate(weights.shape) if n!=1]
+    d0,d1 = (nonunit[0],nonunit[-1]+1) if nonunit else (0,0)
+    if weights.shape[d0:d1]==x.shape[d0:d1]:
+        # e.g. x.shape = (a,b,c,d) and weights.shape = (1,b,c,1):
+        # rows of length d, cycling through the b*c weights
+        # (explicit row count, since -1 is ambiguous when inner is 0)
+        rows,inner = int(np.prod(x.shape[:d1])),int(np.prod(x.shape[d1:]))
+        return x.reshape(rows,inner),weights.ravel()
+    # The weights vary along dims that are not adjacent, e.g. (a,1,c): only
+    # in this case the weights are copied out to the full shape of x
+    return x.reshape(-1,1),np.broadcast_to(weights,x.shape).ravel()
+
+def _numba_dtype(a):
+    ''' Whether the numba kernel can read a directly: numba does not support
+        float16 or non-native byte order (e.g. '>f8' from netCDF3 readers) '''
+    return a.dtype.isnative and (a.dtype in (np.float32,np.float64)
+                                 or a.dtype.kind in 'iu')
+
+def _weighted_nanmean_prebroadcast(x,weights):
+    """ Weighted mean of x ignoring nans, for weights that already broadcast to the shape of x.
+
+    Skips the checks and reshaping in `weighted_nanmean`, so callers that reduce many arrays of the same shape (e.g. one per timestep) can prepare the weights once.
+    """
+    # Prepend length-1 dims, so that weights can be transposed along with x
+    weights = weights.reshape((1,)*(x.ndim-weights.ndim)+weights.shape)
+
+    # The result is a scalar, so the dims can be visited in any order: sort
+    # them by stride to walk x in memory order (and make ravel a view)
+    order = np.argsort([-abs(s) for s in x.strides],kind='stable')
+    x = x.transpose(order)
+    weights = weights.transpose(order)
+
+    if _wnm_cython is not None:
+        x_rows,w = _as_rows(x,weights)
+        # The kernel reads native float32 and float64 x as is
+        if x_rows.dtype not in (np.float32,np.float64):
+            x_rows = x_rows.astype(np.float64)
+        return _wnm_cython(np.ascontiguousarray(x_rows),
+                           np.ascontiguousarray(w,dtype=np.float64))
+
+    if _wnm_kernel is not None and _numba_dtype(x) and _numba_dtype(weights):
+        return _wnm_kernel(*_as_rows(x,weights))
+
+    nan_mask = np.isnan(x)
+    if not nan_mask.any():
+        # Nothing to mask; sum the weights as broadcast to x (a view, no copy).
+        # Unoptimized einsum casts to float64 in small buffers, the optimized
+        # (matmul) path would copy both operands to float64 first
+        dims = 'abcdefghijklmnopqrstuvwxyz'[:x.ndim]
+        num = np.einsum(dims+','+dims+'->',weights,x,dtype=np.float64)
+        return num/np.broadcast_to(weights,x.shape).sum(dtype=np.float64)
 
-    # Remove nans from both x and weights
-    weights = weights[~np.isnan(x)] # this flattens the array
-    x = x[~np.isnan(x)] # x and weights still correspond
+    # Nans in x propagate into weights*x and are skipped by nansum, the
+    # weights are zeroed out where x is nan
+    num = _nansum(weights*x)
+    den = np.where(nan_mask,0.0,weights).sum(dtype=np.float64)
 
-    return np.sum(weights*x)/np.sum(weights)
+    return num/den
 
 if __name__=="__main__":
     # Test array with weights
@@ -62,4 +167,4 @@ if __name__=="__main__":
     # Verifcation array
     x2 = np.array([[[0,1],[2,3],[2,3],[4,5],[4,5],[4,5]],
                    [[6,7],[8,np.nan],[8,np.nan],[10,11],[10,11],[10,11]]],dtype=float)
-    print weighted_nanmean(x,weights=y,axis=1) == np.nanmean(x2)
+    print(weighted_nanmean(x,weights=y,axis=1) == np.nanmean(x2))
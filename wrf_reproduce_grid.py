@@ -43,16 +43,13 @@ def get_wrf_grid_params(wrfout):
 
 def reconstruct_grid(grid_params):
     ''' Given dx,dy,nx and ny as dict,
-        return x,y as 1d and X,Y as 2d grid coordinates '''
+        return x,y as 1d and X,Y as 2d grid coordinates (float32)
+        (X,Y are broadcast views on x,y: copy them before writing to them) '''
 
-    def make_grid_coordinate(nx,dx):
+    def make_grid_coordinate(nx,dx,dtype=np.float32):
         ''' Given a number of grid points and grid spacing,
         return a 1D-array centered around 0 '''
-        if nx%2 == 1:
-            ix = np.arange(-(nx//2),nx//2+1,1)
-        else:
-            ix = np.arange(-(nx-1)/2.,(nx+1)//2.,1)
-        return ix*dx
+        return ((np.arange(nx,dtype=np.float64)-(nx-1)*0.5)*dx).astype(dtype)
 
     # Mass point coordinates
     x = make_grid_coordinate(grid_params["nx"],grid_params["dx"])
@@ -60,31 +57,41 @@ def reconstruct_grid(grid_params):
 
     # Staggered coordinates
     x_stag = make_grid_coordinate(grid_params["nx"]+1,grid_params["dx"])
-    y_stag = make_grid_coordinate(grid_params["nx"]+1,grid_params["dx"])
+    y_stag = make_grid_coordinate(grid_params["ny"]+1,grid_params["dy"])
 
-    # 2d meshgrids
-    mass_grid = np.meshgrid(x,y)
-    u_grid = np.meshgrid(x_stag,y)
-    v_grid = np.meshgrid(x,y_stag)
+    # 2d meshgrids, as broadcast views on the 1d coordinates (no copies)
+    mass_grid = np.broadcast_arrays(*np.meshgrid(x,y,sparse=True,copy=False))
+    u_grid = np.broadcast_arrays(*np.meshgrid(x_stag,y,sparse=True,copy=False))
+    v_grid = np.broadcast_arrays(*np.meshgrid(x,y_stag,sparse=True,copy=False))
 
     coords = {"x":x,"y":y,"x_stag":x_stag,"y_stag":y_stag}
     grids = {"mass_grid":mass_grid,"u_grid":u_grid,"v_grid":v_grid}
     return coords,grids
 
+def check_reconstructed_grid_shapes():
+    ''' Verify that reconstruct_grid staggers u along x and v along y,
+        on a non-square grid so that mixing up nx and ny would show '''
+    coords,grids = reconstruct_grid({"nx":5,"ny":3,"dx":1.,"dy":2.})
+    for X in grids["u_grid"]:
+        assert X.shape==(3,6), "u_grid should have shape (ny,nx+1)"
+    for X in grids["v_grid"]:
+        assert X.shape==(4,5), "v_grid should have shape (ny+1,nx)"
+    return
+
 def load_wrf_grids(wrfout):
     ''' Given a wrfout file as xarray dataset object,
-        return a dictionary with the mass and staggered coordinates '''
+        return a dictionary with the mass and staggered coordinates (float32) '''
 
-    x = wrfout.XLONG.isel(Time=0).values
-    y = wrfout.XLAT.isel(Time=0).values
+    x = wrfout.XLONG.isel(Time=0).values.astype(np.float32,copy=False)
+    y = wrfout.XLAT.isel(Time=0).values.astype(np.float32,copy=False)
     mass_grid = (x,y)
 
-    x_u_stag = wrfout.XLONG_U.isel(Time=0).values
-    y_u_stag = wrfout.XLAT_U.isel(Time=0).values
+    x_u_stag = wrfout.XLONG_U.isel(Time=0).values.astype(np.float32,copy=False)
+    y_u_stag = wrfout.XLAT_U.isel(Time=0).values.astype(np.float32,copy=False)
     u_grid = (x_u_stag,y_u_stag)
 
-    x_v_stag = wrfout.XLONG_V.isel(Time=0).values
-    y_v_stag = wrfout.XLAT_V.isel(Time=0).values
+    x_v_stag = wrfout.XLONG_V.isel(Time=0).values.astype(np.float32,copy=False)
+    y_v_stag = wrfout.XLAT_V.isel(Time=0).values.astype(np.float32,copy=False)
     v_grid = (x_v_stag,y_v_stag)
 
     return {"mass_grid":mass_grid,"u_grid":u_grid,"v_grid":v_grid}
@@ -94,28 +101,50 @@ def check_grid_consistency(grid1,grid2,proj1,proj2):
         perform a number of checks to verify their consistency '''
 
     def print_diffs(xt,yt,x2,y2):
-        print 'Total accumulated longitude mismatch:',(xt-x2).sum()
-        print 'Total accumulated latitude mismatch:',(yt-y2).sum()
-        print 'Average longitudinal grid mismatch:',(xt-x2).mean()
-        print 'Average latitudinal mismatch:',(yt-y2).mean()
-        print 'Maximum longitudinal grid mismatch:',(xt-x2).max(),np.unravel_index((xt-x2).argmax(),xt.shape)
-        print 'Maximum latitudinal mismatch:',(yt-y2).max(),np.unravel_index((yt-y2).argmax(),yt.shape),'\n'
+        # Compute the differences once and reuse them for all statistics
+        diff_x = xt-x2
+        diff_y = yt-y2
+        ix = diff_x.argmax()
+        iy = diff_y.argmax()
+        print('Total accumulated longitude mismatch:',diff_x.sum())
+        print('Total accumulated latitude mismatch:',diff_y.sum())
+        print('Average longitudinal grid mismatch:',diff_x.mean())
+        print('Average latitudinal mismatch:',diff_y.mean())
+        print('Maximum longitudinal grid mismatch:',diff_x.flat[ix],np.unravel_index(ix,diff_x.shape))
+        print('Maximum latitudinal mismatch:',diff_y.flat[iy],np.unravel_index(iy,diff_y.shape),'\n')
         return
 
+    def transform_tiled(transformer,x,y,tile=65536):
+        # Transform in chunks of 65536 points, so the inputs, outputs and
+        # PROJ's own state stay in cache: 256 KB per float32 coordinate, and
+        # 512 KB in the float64 buffers that pyproj converts them to
+        x,y = np.broadcast_arrays(x,y)
+        # pyproj returns float64, which is cast back to the input dtype
+        xt = np.empty(x.size,dtype=x.dtype)
+        yt = np.empty(y.size,dtype=y.dtype)
+        for s in range(0,x.size,tile):
+            xt[s:s+tile],yt[s:s+tile] = transformer.transform(x.flat[s:s+tile],
+                                                              y.flat[s:s+tile])
+        return xt.reshape(x.shape),yt.reshape(y.shape)
+
+    # Set up both transformations once and reuse them for all grids
+    fwd = pyproj.Transformer.from_proj(proj1,proj2,always_xy=True)
+    inv = pyproj.Transformer.from_proj(proj2,proj1,always_xy=True)
+
     for grid in ['mass_grid','u_grid','v_grid']:
-        print 'Performing transformation on the %s'%grid
+        print('Performing transformation on the %s'%grid)
 
-        x1,y1 = grid1['mass_grid']
-        x2,y2 = grid2['mass_grid']
+        x1,y1 = grid1[grid]
+        x2,y2 = grid2[grid]
 
         # Transform proj1 to proj 2
-        print 'Transform proj1 to proj2 (probably LCC to lat/lon)'
-        xt,yt = pyproj.transform(proj1,proj2,x1,y1)
+        print('Transform proj1 to proj2 (probably LCC to lat/lon)')
+        xt,yt = transform_tiled(fwd,x1,y1)
         print_diffs(xt,yt,x2,y2)
 
         # Transform proj2 to proj 1
-        print 'Transform proj2 to proj1 (probably lat/lon to LCC)'
-        xt,yt = pyproj.transform(proj2,proj1,x2,y2)
+        print('Transform proj2 to proj1 (probably lat/lon to LCC)')
+        xt,yt = transform_tiled(inv,x2,y2)
         print_diffs(xt,yt,x1,y1)
 
     return
@@ -150,6 +179,9 @@ def reproduce_wrf_grid(wrfout):
     return coords_peter, grids_peter
 
 if __name__=="__main__":
+    # Self-check that does not need any WRF output
+    check_reconstructed_grid_shapes()
+
     # Sample wrf output
     wrfpath = '/scratch-shared/peter919/case00_ACM2/wrfout_d01_2013-03-20_00:00:00'
     wrfout = xr.open_dataset(wrfpath)